@@ -1,6 +1,6 @@
 from src.data.transformation.perspective import RandomPerspective
 from src.data.transformation.resize import Resize
-from src.data.transformation.remap import toNumpy, Remap
+from src.data.transformation.remap import toNumpy, Remap, RemapToNumpy
 from src.data.transformation.to import To
 from src.data.transformation.batcher import Sample2Batch, Batch2Sample
 from src.data.transformation.concat import Concat, unConcat
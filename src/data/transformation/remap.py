@@ -1,24 +1,61 @@
 from typing import overload
 
 import numpy as np
+import torch
 from torch import Tensor
 
 
 class toNumpy:
+    def __init__(self, pinned: bool = False) -> None:
+        """
+        Parameters
+        ----------
+        pinned : bool, optional
+            if True, CUDA tensors are copied through a page-locked buffer,
+            which makes the device to host copy faster. The copy is still
+            waited for before returning, so it does not overlap with GPU
+            compute. Other devices use a plain `.cpu()`, by default False.
+        """
+        self.pinned = pinned
+
     def __call__(self, imgs: Tensor) -> np.ndarray:
-        # remove autograd function and move to cpu
-        imgs = imgs.detach().cpu()
+        # remove autograd function and move to cpu. Tensors that are already
+        # on the cpu without autograd are used as is.
+        if imgs.requires_grad:
+            imgs = imgs.detach()
+
+        if imgs.device.type != "cpu":
+            imgs = self.to_cpu(imgs)
+
+        # cast only when needed, as it copies the whole tensor
+        if imgs.dtype != torch.float32:
+            imgs = imgs.to(torch.float32)
 
-        # invert channels in numpy's order
+        # invert channels in numpy's order. The permutation only changes the
+        # strides, so the array shares the memory of the tensor.
         if len(imgs.shape) == 3:
             imgs_norm = imgs.permute(1, 2, 0)
         elif len(imgs.shape) == 4:
             imgs_norm = imgs.permute(0, 2, 3, 1)
 
-        imgs_np = imgs_norm.numpy().astype(np.float32)
+        imgs_np = imgs_norm.numpy()
 
         return imgs_np
 
+    def to_cpu(self, imgs: Tensor) -> Tensor:
+        if not (self.pinned and imgs.is_cuda):
+            return imgs.cpu()
+
+        # empty_like keeps the memory format, e.g. channels last
+        cpu_imgs = torch.empty_like(imgs, device="cpu", pin_memory=True)
+        cpu_imgs.copy_(imgs, non_blocking=True)
+
+        # numpy reads the buffer right away, so the copy must be over
+        # before returning
+        torch.cuda.current_stream(imgs.device).synchronize()
+
+        return cpu_imgs
+
 
 class Remap:
     def __init__(
@@ -27,11 +64,33 @@ class Remap:
         in_max: float | Tensor,
         out_min: float | Tensor = -1,
         out_max: float | Tensor = 1,
+        inplace: bool = False,
     ) -> None:
+        """
+        Parameters
+        ----------
+        in_min : float | Tensor
+            lower bound of the input range.
+        in_max : float | Tensor
+            upper bound of the input range.
+        out_min : float | Tensor, optional
+            lower bound of the output range, by default -1
+        out_max : float | Tensor, optional
+            upper bound of the output range, by default 1
+        inplace : bool, optional
+            if True, overwrite the given tensors instead of allocating new
+            ones. They must already have a floating point dtype, by default
+            False.
+        """
         self.in_min = in_min
         self.in_max = in_max
         self.out_min = out_min
         self.out_max = out_max
+        self.inplace = inplace
+
+        # (x - in_min) * scale + out_min == x * scale + bias
+        self._scale = (out_max - out_min) / (in_max - in_min)
+        self._bias = out_min - in_min * self._scale
 
     @overload
     def __call__(self, imgs: dict[str, Tensor]) -> dict[str, Tensor]: ...
@@ -40,18 +99,13 @@ class Remap:
     def __call__(self, imgs: Tensor) -> Tensor: ...
 
     def __call__(self, imgs):
-        scale_factor = (self.out_max - self.out_min) / (self.in_max - self.in_min)
-
         if isinstance(imgs, dict):
-            imgs["streetview"] = (
-                imgs["streetview"] - self.in_min
-            ) * scale_factor + self.out_min
-            imgs["simulated"] = (
-                imgs["simulated"] - self.in_min
-            ) * scale_factor + self.out_min
+            imgs["streetview"], imgs["simulated"] = self.remap_foreach(
+                [imgs["streetview"], imgs["simulated"]]
+            )
 
         elif isinstance(imgs, Tensor):
-            imgs = (imgs - self.in_min) * scale_factor + self.out_min
+            imgs = self.remap(imgs)
 
         else:
             raise TypeError(
@@ -60,3 +114,83 @@ class Remap:
             )
 
         return imgs
+
+    def remap(self, img: Tensor) -> Tensor:
+        """apply the affine transformation, allocating at most the output tensor."""
+        if self.inplace:
+            return img.mul_(self._scale).add_(self._bias)
+
+        return img.mul(self._scale).add_(self._bias)
+
+    def remap_foreach(self, imgs: list[Tensor]) -> list[Tensor]:
+        """
+        apply the affine transformation to several tensors with one
+        `torch._foreach_*` call per operation, which launches one kernel for
+        all the tensors instead of one per tensor.
+        """
+        # the foreach scalar overloads do not take tensor ranges
+        if isinstance(self._scale, Tensor) or isinstance(self._bias, Tensor):
+            return [self.remap(img) for img in imgs]
+
+        if self.inplace:
+            torch._foreach_mul_(imgs, self._scale)
+        else:
+            imgs = list(torch._foreach_mul(imgs, self._scale))
+
+        torch._foreach_add_(imgs, self._bias)
+
+        return imgs
+
+
+class RemapToNumpy:
+    """
+    fused equivalent of `Compose([Remap(...), toNumpy()])`. The scaled input
+    is written straight into a float32 tensor, which is then shifted in place
+    and viewed as a numpy array. Non-float32 inputs therefore skip the cast
+    that `toNumpy` would otherwise do.
+    """
+
+    def __init__(
+        self,
+        in_min: float | Tensor,
+        in_max: float | Tensor,
+        out_min: float | Tensor = -1,
+        out_max: float | Tensor = 1,
+        channels_last: bool = False,
+        pinned: bool = False,
+    ) -> None:
+        """
+        Parameters
+        ----------
+        in_min, in_max, out_min, out_max : float | Tensor
+            input and output ranges, see `Remap`.
+        channels_last : bool, optional
+            if True, batches are remapped in channels last memory format, so
+            that the returned (N, H, W, C) array is C-contiguous, by default
+            False.
+        pinned : bool, optional
+            see `toNumpy`, by default False.
+        """
+        self.remap = Remap(in_min, in_max, out_min, out_max)
+        self.to_numpy = toNumpy(pinned)
+        self.channels_last = channels_last
+
+    def __call__(self, imgs: Tensor) -> np.ndarray:
+        if not isinstance(imgs, Tensor):
+            raise TypeError(
+                f"type {type(imgs)} is not supported. Please use a Tensor "
+                "with shape (C, H, W) or (N, C, H, W)."
+            )
+
+        memory_format = torch.contiguous_format
+        if self.channels_last and len(imgs.shape) == 4:
+            memory_format = torch.channels_last
+
+        # the remap happens on the device of the input, before the transfer to the cpu
+        remapped = torch.empty_like(
+            imgs, dtype=torch.float32, memory_format=memory_format
+        )
+        torch.mul(imgs.detach(), self.remap._scale, out=remapped)
+        remapped.add_(self.remap._bias)
+
+        return self.to_numpy(remapped)